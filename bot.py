@@ -1,12 +1,18 @@
 import os
+import io
+import asyncio
 import re
+import time
 import uuid
+import base64
 import zipfile
+import tempfile
 import logging
-import requests
-import subprocess
+import functools
+import aiohttp
+from cachetools import TTLCache
 from urllib.parse import urlparse
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, InputFile
 from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, filters, ContextTypes
 from telegram.error import BadRequest
 
@@ -19,26 +25,111 @@ logger = logging.getLogger(__name__)
 # Environment Variables
 TOKEN = os.environ.get("BOT_TOKEN", "YOUR_TELEGRAM_BOT_TOKEN_HERE")
 REQUIRED_CHANNEL = os.environ.get("REQUIRED_CHANNEL", "@C0nver1_bot") # Must include @
-
-# Dictionary to temporarily store user files for the "download chats" feature
-user_sessions = {}
+MAX_FFMPEG_JOBS = max(1, int(os.environ.get("MAX_FFMPEG_JOBS", os.cpu_count() or 2)))
+MAX_DOWNLOADS = max(1, int(os.environ.get("MAX_DOWNLOADS", 4)))
 
 # Ensure temp directory exists
 TEMP_DIR = "temp_downloads"
+TEMP_PREFIX = TEMP_DIR + os.sep
 os.makedirs(TEMP_DIR, exist_ok=True)
 
+SESSION_TTL = 60 * 60
+CONVERSION_TTL = 60 * 60
+
+# Telegram bots cannot upload files larger than 50MB
+MAX_UPLOAD_SIZE = 49 * 1024 * 1024
+# Read link downloads in 1 MiB blocks
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+# Link downloads and ZIP archives up to this size stay in memory; bigger ones spill to TEMP_DIR
+SPOOL_SIZE = 16 * 1024 * 1024
+
+# Matches direct http(s) links sent as plain text
+URL_RE = re.compile(r'^https?://', re.ASCII)
+
+# Image formats ffmpeg can write to stdout, mapped to their encoder
+PIPE_IMAGE_CODECS = {"png": "png", "webp": "libwebp", "jpg": "mjpeg"}
+
+# Bound parallel ffmpeg processes and downloads so a burst of users can't exhaust RAM.
+# python-telegram-bot reads each upload fully into memory, so every download slot can
+# hold up to about MAX_UPLOAD_SIZE while it uploads.
+FFMPEG_SEM = asyncio.Semaphore(MAX_FFMPEG_JOBS)
+NET_SEM = asyncio.Semaphore(MAX_DOWNLOADS)
+
+
+def short_id() -> str:
+    """Return a random 22-character URL-safe id."""
+    return base64.urlsafe_b64encode(uuid.uuid4().bytes).rstrip(b"=").decode()
+
+
+def remove_files(files) -> None:
+    """Delete the given files, ignoring ones that are already gone."""
+    for file in files:
+        try:
+            os.unlink(file)
+        except FileNotFoundError:
+            pass
+
+
+class SessionCache(TTLCache):
+    """TTLCache that collects the files of evicted or expired sessions for deletion off the event loop."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.evicted_files = []
+
+    def popitem(self):
+        key, files = super().popitem()
+        self.evicted_files.extend(files)
+        return key, files
+
+    def expire(self, time=None):
+        expired = super().expire(time)
+        for _, files in expired:
+            self.evicted_files.extend(files)
+        return expired
+
+    def take_evicted_files(self) -> list[str]:
+        """Return and forget the files of sessions dropped since the last call."""
+        files, self.evicted_files = self.evicted_files, []
+        return files
+
+
+# Temporarily store user files for the "download chats" feature
+user_sessions = SessionCache(maxsize=10_000, ttl=SESSION_TTL)
+
+# Recent channel membership results, so a burst of messages costs one getChatMember call
+sub_cache = TTLCache(maxsize=100_000, ttl=60)
+
+# Random tokens used in inline button callback_data, mapped to (user_id, filepath, created_at).
+# Telegram limits callback_data to 64 bytes, so paths can't be embedded directly.
+pending_conversions: dict[str, tuple[int, str, float]] = {}
+
+# Shared HTTP session for link downloads (created in post_init)
+http_session: aiohttp.ClientSession | None = None
+
+
+async def remove_evicted_files() -> None:
+    """Delete the files of expired or evicted sessions in a worker thread."""
+    files = user_sessions.take_evicted_files()
+    if files:
+        await asyncio.to_thread(remove_files, files)
+
 
 async def check_subscription(user_id: int, context: ContextTypes.DEFAULT_TYPE) -> bool:
     """Check if the user is a member of the required channel."""
     if not REQUIRED_CHANNEL or REQUIRED_CHANNEL == "NONE":
         return True # Skip check if no channel is configured
+
+    cached = sub_cache.get(user_id)
+    if cached is not None:
+        return cached
         
     try:
         member = await context.bot.get_chat_member(chat_id=REQUIRED_CHANNEL, user_id=user_id)
         # Valid statuses: 'member', 'administrator', 'creator', 'restricted' (if still in chat)
-        if member.status in ['left', 'kicked']:
-            return False
-        return True
+        is_member = member.status not in ['left', 'kicked']
+        sub_cache[user_id] = is_member
+        return is_member
     except BadRequest as e:
         logger.error(f"Failed to check membership. Is bot an admin in {REQUIRED_CHANNEL}? Error: {e}")
         # If the bot is not an admin, it throws an error. We return False to prevent unauthorized access,
@@ -64,13 +155,51 @@ async def send_join_prompt(message) -> None:
     )
 
 
+def require_sub(func):
+    """Only run the handler if the user has joined the required channel."""
+    @functools.wraps(func)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        if not await check_subscription(update.effective_user.id, context):
+            await send_join_prompt(update.message)
+            return
+        return await func(update, context)
+    return wrapper
+
+
+async def run_ffmpeg(*args: str) -> bytes:
+    """Run ffmpeg without blocking the event loop and return its stdout, raising if it fails."""
+    async with FFMPEG_SEM:
+        proc = await asyncio.create_subprocess_exec(
+            "ffmpeg", "-y", *args,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE
+        )
+        stdout, stderr = await proc.communicate()
+
+    if proc.returncode != 0:
+        logger.error(f"ffmpeg exited with code {proc.returncode}: {stderr.decode(errors='replace')[-500:]}")
+        raise RuntimeError(f"ffmpeg exited with code {proc.returncode}")
+    return stdout
+
+
+async def probe_audio_codec(filepath: str) -> str | None:
+    """Return the codec name of the first audio stream, or None if it can't be determined."""
+    async with FFMPEG_SEM:
+        proc = await asyncio.create_subprocess_exec(
+            "ffprobe", "-v", "error", "-select_streams", "a:0",
+            "-show_entries", "stream=codec_name", "-of", "default=noprint_wrappers=1:nokey=1", filepath,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.DEVNULL
+        )
+        stdout, _ = await proc.communicate()
+    if proc.returncode != 0:
+        return None
+    return stdout.decode().strip() or None
+
+
+@require_sub
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Send a message when the command /start is issued."""
-    user_id = update.effective_user.id
-    if not await check_subscription(user_id, context):
-        await send_join_prompt(update.message)
-        return
-
     welcome_text = (
         "👋 Welcome to the Ultimate Converter & Downloader Bot!\n\n"
         "Here is what I can do:\n"
@@ -83,58 +212,52 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     await update.message.reply_text(welcome_text, parse_mode="Markdown")
 
 
+@require_sub
 async def handle_link(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Download a file from a direct link and send it back."""
-    user_id = update.effective_user.id
-    if not await check_subscription(user_id, context):
-        await send_join_prompt(update.message)
-        return
-
     url = update.message.text
-    if not re.match(r'^https?://', url):
+    if not URL_RE.match(url):
         return # Not a link, ignore
 
     message = await update.message.reply_text("⏳ Downloading file from link...")
     
     try:
         parsed_url = urlparse(url)
-        filename = os.path.basename(parsed_url.path) or f"download_{uuid.uuid4().hex[:8]}.file"
-        filepath = os.path.join(TEMP_DIR, filename)
-
-        response = requests.get(url, stream=True, timeout=10)
-        response.raise_for_status()
-        
-        with open(filepath, 'wb') as f:
-            for chunk in response.iter_content(chunk_size=8192):
-                f.write(chunk)
-
-        file_size = os.path.getsize(filepath)
-        if file_size > 49 * 1024 * 1024:
-            await message.edit_text("❌ File is larger than 50MB. Telegram restricts bots from uploading files larger than 50MB.")
-            os.remove(filepath)
-            return
+        filename = os.path.basename(parsed_url.path) or f"download_{short_id()}.file"
+
+        # Keep the download slot until the upload is done, so MAX_DOWNLOADS also caps how many bodies are uploading at once
+        async with NET_SEM:
+            with tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE, dir=TEMP_DIR) as body:
+                async with http_session.get(url) as resp:
+                    resp.raise_for_status()
+
+                    # Abort before downloading if the server already tells us it's too big
+                    if resp.content_length and resp.content_length > MAX_UPLOAD_SIZE:
+                        await message.edit_text("❌ File is larger than 50MB. Telegram restricts bots from uploading files larger than 50MB.")
+                        return
+
+                    # Count the received bytes too, since Content-Length is the compressed size
+                    async for chunk in resp.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+                        body.write(chunk)
+                        if body.tell() > MAX_UPLOAD_SIZE:
+                            await message.edit_text("❌ File is larger than 50MB. Telegram restricts bots from uploading files larger than 50MB.")
+                            return
+
+                await message.edit_text("📤 Uploading to Telegram...")
+                body.seek(0)
+                await update.message.reply_document(document=body, filename=filename)
 
-        await message.edit_text("📤 Uploading to Telegram...")
-        with open(filepath, 'rb') as f:
-            await update.message.reply_document(document=f)
-            
         await message.delete()
 
     except Exception as e:
         logger.error(f"Error downloading link: {e}")
         await message.edit_text(f"❌ Failed to download or send the file. Make sure it's a direct download link.\nError: {str(e)[:50]}")
-    finally:
-        if 'filepath' in locals() and os.path.exists(filepath):
-            os.remove(filepath)
 
 
+@require_sub
 async def handle_media(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Handle incoming images, videos, and documents."""
     user_id = update.effective_user.id
-    if not await check_subscription(user_id, context):
-        await send_join_prompt(update.message)
-        return
-
     message = update.message
     file_obj = None
     file_type = None
@@ -164,26 +287,31 @@ async def handle_media(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
         elif file_type == "video":
             ext = ".mp4"
 
-        filepath = os.path.join(TEMP_DIR, f"{uuid.uuid4().hex}{ext}")
-        await telegram_file.download_to_drive(filepath)
+        filepath = f"{TEMP_PREFIX}{short_id()}{ext}"
+        async with NET_SEM:
+            await telegram_file.download_to_drive(filepath)
 
-        if user_id not in user_sessions:
-            user_sessions[user_id] = []
-        user_sessions[user_id].append(filepath)
+        # Re-assign so the session's TTL restarts on every new file
+        user_sessions[user_id] = user_sessions.get(user_id, []) + [filepath]
+        await remove_evicted_files()
 
         if file_type == "image":
+            token = short_id()
+            pending_conversions[token] = (user_id, filepath, time.monotonic())
             keyboard = [
                 [
-                    InlineKeyboardButton("Convert to PNG", callback_data=f"conv_png_{filepath}"),
-                    InlineKeyboardButton("Convert to WEBP", callback_data=f"conv_webp_{filepath}")
+                    InlineKeyboardButton("Convert to PNG", callback_data=f"conv_png_{token}"),
+                    InlineKeyboardButton("Convert to WEBP", callback_data=f"conv_webp_{token}")
                 ],
-                [InlineKeyboardButton("Convert to PDF", callback_data=f"conv_pdf_{filepath}")]
+                [InlineKeyboardButton("Convert to PDF", callback_data=f"conv_pdf_{token}")]
             ]
             reply_markup = InlineKeyboardMarkup(keyboard)
             await status_msg.edit_text("File saved to your session! Do you want to convert it?", reply_markup=reply_markup)
             
         elif file_type == "video":
-            keyboard = [[InlineKeyboardButton("Extract Audio (MP3)", callback_data=f"conv_mp3_{filepath}")]]
+            token = short_id()
+            pending_conversions[token] = (user_id, filepath, time.monotonic())
+            keyboard = [[InlineKeyboardButton("Extract Audio (MP3)", callback_data=f"conv_mp3_{token}")]]
             reply_markup = InlineKeyboardMarkup(keyboard)
             await status_msg.edit_text("Video saved to your session! Do you want to extract audio?", reply_markup=reply_markup)
             
@@ -205,6 +333,8 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 
     # Check for the "Refresh / I joined" button
     if data == "check_sub":
+        # The user says they just joined, so don't trust a cached "not a member"
+        sub_cache.pop(user_id, None)
         if await check_subscription(user_id, context):
             await query.edit_message_text("✅ Thank you for joining! You can now use the bot. Send /start to see the menu.")
         else:
@@ -220,9 +350,11 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     if data.startswith("conv_"):
         parts = data.split("_", 2)
         action = parts[1]
-        filepath = parts[2]
+        entry = pending_conversions.get(parts[2]) if len(parts) == 3 else None
+        # Tokens are only valid for the user who uploaded the file
+        filepath = entry[1] if entry and entry[0] == user_id else None
 
-        if not os.path.exists(filepath):
+        if not filepath or not os.path.exists(filepath):
             await query.edit_message_text("❌ File expired or no longer exists on the server.")
             return
 
@@ -232,86 +364,166 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             output_ext = f".{action}"
             output_path = f"{os.path.splitext(filepath)[0]}_converted{output_ext}"
 
-            if action in ["png", "webp", "jpg", "pdf"]:
-                subprocess.run(["ffmpeg", "-y", "-i", filepath, output_path], check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-            elif action == "mp3":
-                subprocess.run(["ffmpeg", "-y", "-i", filepath, "-q:a", "0", "-map", "a", output_path], check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-
-            if os.path.exists(output_path):
+            if action in PIPE_IMAGE_CODECS:
+                # Read the converted image from ffmpeg's stdout instead of a temp file
+                output = await run_ffmpeg("-i", filepath, "-f", "image2pipe", "-c:v", PIPE_IMAGE_CODECS[action], "pipe:1")
+                if not output:
+                    await query.edit_message_text("❌ Conversion failed.")
+                    return
                 await query.edit_message_text("📤 Uploading converted file...")
-                with open(output_path, 'rb') as f:
-                    await context.bot.send_document(chat_id=query.message.chat_id, document=f)
-                os.remove(output_path)
+                filename = f"{os.path.splitext(os.path.basename(filepath))[0]}_converted{output_ext}"
+                await context.bot.send_document(chat_id=query.message.chat_id, document=InputFile(io.BytesIO(output), filename=filename))
                 await query.message.delete()
-            else:
+                return
+
+            if action == "pdf":
+                await run_ffmpeg("-i", filepath, output_path)
+            elif action == "mp3":
+                if await probe_audio_codec(filepath) == "mp3":
+                    # Already MP3: copy the stream instead of re-encoding it
+                    await run_ffmpeg("-i", filepath, "-vn", "-map", "a:0", "-c:a", "copy", output_path)
+                else:
+                    await run_ffmpeg("-i", filepath, "-q:a", "0", "-map", "a", output_path)
+
+            try:
+                f = open(output_path, 'rb')
+            except FileNotFoundError:
                 await query.edit_message_text("❌ Conversion failed.")
+                return
+
+            await query.edit_message_text("📤 Uploading converted file...")
+            with f:
+                await context.bot.send_document(chat_id=query.message.chat_id, document=f)
+            os.unlink(output_path)
+            await query.message.delete()
 
         except Exception as e:
             logger.error(f"Conversion error: {e}")
             await query.edit_message_text("❌ An error occurred during conversion.")
 
 
+class ZipTooLarge(Exception):
+    """Raised when an archive grows past MAX_UPLOAD_SIZE while it is being built."""
+
+
+def build_zip(archive, files: list[str]) -> None:
+    """Pack files into an uncompressed ZIP written to archive, stopping once it's too big to upload."""
+    # Uploads are mostly already-compressed media, so DEFLATE would only burn CPU
+    with zipfile.ZipFile(archive, 'w', zipfile.ZIP_STORED, allowZip64=True) as zipf:
+        for file in files:
+            try:
+                zipf.write(file, os.path.basename(file))
+            except FileNotFoundError:
+                continue
+            if archive.tell() > MAX_UPLOAD_SIZE:
+                raise ZipTooLarge()
+
+
+@require_sub
 async def zip_files(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Zip all files in the user's session and send them back."""
     user_id = update.effective_user.id
-    if not await check_subscription(user_id, context):
-        await send_join_prompt(update.message)
-        return
-    
+
     if user_id not in user_sessions or not user_sessions[user_id]:
         await update.message.reply_text("⚠️ You have no files saved in your session. Send me some pics/files first!")
         return
 
     message = await update.message.reply_text("⏳ Zipping your files...")
-    zip_filename = os.path.join(TEMP_DIR, f"Archive_{user_id}_{uuid.uuid4().hex[:6]}.zip")
-    
-    try:
-        with zipfile.ZipFile(zip_filename, 'w') as zipf:
-            for file in user_sessions[user_id]:
-                if os.path.exists(file):
-                    zipf.write(file, os.path.basename(file))
-                    os.remove(file) 
+    files = user_sessions[user_id]
+    user_sessions[user_id] = []
+    await remove_evicted_files()
 
-        user_sessions[user_id] = []
+    # Small archives stay in memory; bigger ones spill over to a temp file on disk
+    with tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE, dir=TEMP_DIR, suffix=".zip") as archive:
+        try:
+            await asyncio.to_thread(build_zip, archive, files)
 
-        if os.path.getsize(zip_filename) > 49 * 1024 * 1024:
-            await message.edit_text("❌ The resulting ZIP is over 50MB. Telegram bots cannot upload files this large.")
-            return
+            await message.edit_text("📤 Uploading ZIP...")
+            archive.seek(0)
+            await update.message.reply_document(document=archive, filename=f"Archive_{user_id}_{short_id()}.zip")
 
-        await message.edit_text("📤 Uploading ZIP...")
-        with open(zip_filename, 'rb') as f:
-            await update.message.reply_document(document=f)
-            
-        await message.delete()
+            await message.delete()
 
-    except Exception as e:
-        logger.error(f"Zip error: {e}")
-        await message.edit_text("❌ Error creating ZIP file.")
-    finally:
-        if os.path.exists(zip_filename):
-            os.remove(zip_filename)
+        except ZipTooLarge:
+            await message.edit_text("❌ The resulting ZIP is over 50MB. Telegram bots cannot upload files this large.")
+        except Exception as e:
+            logger.error(f"Zip error: {e}")
+            await message.edit_text("❌ Error creating ZIP file.")
+        finally:
+            await asyncio.to_thread(remove_files, files)
 
 
+@require_sub
 async def clear_session(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Clear the user's current session files."""
     user_id = update.effective_user.id
-    if not await check_subscription(user_id, context):
-        await send_join_prompt(update.message)
-        return
-
     if user_id in user_sessions:
-        for file in user_sessions[user_id]:
-            if os.path.exists(file):
-                os.remove(file)
+        files = user_sessions[user_id]
         user_sessions[user_id] = []
+        await asyncio.to_thread(remove_files, files + user_sessions.take_evicted_files())
         await update.message.reply_text("🧹 Session cleared. All temporary files deleted.")
     else:
         await update.message.reply_text("⚠️ Your session is already empty.")
 
 
+async def sweep_pending_conversions(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Forget conversion tokens older than CONVERSION_TTL."""
+    cutoff = time.monotonic() - CONVERSION_TTL
+    expired = [token for token, (_, _, created_at) in pending_conversions.items() if created_at < cutoff]
+    for token in expired:
+        del pending_conversions[token]
+
+
+def remove_stale_temp_files(in_use: set[str]) -> None:
+    """Delete temp files older than SESSION_TTL that no session references."""
+    cutoff = time.time() - SESSION_TTL
+    with os.scandir(TEMP_DIR) as entries:
+        for entry in entries:
+            if entry.path in in_use:
+                continue
+            # Files can vanish mid-sweep when a handler cleans up, so stat inside the try
+            try:
+                if entry.is_file() and entry.stat().st_mtime < cutoff:
+                    os.remove(entry.path)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logger.warning(f"Could not remove stale temp file {entry.path}: {e}")
+
+
+async def sweep_temp_dir(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Expire idle sessions and delete orphaned temp files, off the event loop."""
+    user_sessions.expire()
+    await remove_evicted_files()
+    in_use = {file for files in user_sessions.values() for file in files}
+    await asyncio.to_thread(remove_stale_temp_files, in_use)
+
+
+async def post_init(application: Application) -> None:
+    """Create the shared HTTP session once the event loop is running."""
+    global http_session
+    # One pooled session for all link downloads: keep-alive, TLS session reuse and DNS caching
+    connector = aiohttp.TCPConnector(limit=50, limit_per_host=10, ttl_dns_cache=300)
+    # Time out stalled connections and reads (like requests' timeout=10), not slow but steady transfers
+    timeout = aiohttp.ClientTimeout(total=None, sock_connect=10, sock_read=30)
+    http_session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+
+
+async def post_shutdown(application: Application) -> None:
+    """Close the shared HTTP session."""
+    if http_session is not None:
+        await http_session.close()
+
+
 def main() -> None:
     """Start the bot."""
-    application = Application.builder().token(TOKEN).build()
+    application = (
+        Application.builder()
+        .token(TOKEN)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
 
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("zip", zip_files))
@@ -321,6 +533,9 @@ def main() -> None:
     application.add_handler(MessageHandler(filters.PHOTO | filters.VIDEO | filters.Document.ALL, handle_media))
     application.add_handler(CallbackQueryHandler(button_callback))
 
+    application.job_queue.run_repeating(sweep_pending_conversions, interval=15 * 60)
+    application.job_queue.run_repeating(sweep_temp_dir, interval=15 * 60)
+
     application.run_polling(allowed_updates=Update.ALL_TYPES)
 
 if __name__ == "__main__":